@@ -18,12 +18,21 @@ Usage:
 
 import os
 import sys
+import zipfile
 import torch
 import torch.nn as nn
 import numpy as np
-from collections import deque
+from collections import deque, namedtuple
 from pathlib import Path
 
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+# torch.load(mmap=...) and load_state_dict(assign=...) appeared in torch 2.1
+TORCH_HAS_MMAP = tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 1)
+
 
 # ==========================================
 # 1. NEURAL NETWORK (DQN)
@@ -57,21 +66,324 @@ class DQNAgent:
         
         self.policy_net = DQN(state_size, action_size).to(device)
         self.policy_net.eval()
+        
+        # Reused input buffer for batched inference (pinned when copying to GPU)
+        self._state_buffer = None
+        
+        # Set once torch.compile has wrapped the policy network
+        self._compiled = False
+        
+        # Float policy kept aside while the inference copy is quantized
+        self._float_net = None
+        
+        # CUDA graph of the batched forward pass, recorded on first use
+        self._graph = None
+        self._static_in = None
+        self._static_out = None
+        
+        # Actions of the last submit_batch: a NumPy array, or on CUDA (when
+        # _pending_on_gpu is set) a pinned host buffer filled asynchronously
+        # and the event marking it ready
+        self._pending = None
+        self._pending_on_gpu = False
+        self._action_buffer = None
+        self._action_ready = None
+        
+        # ONNX Runtime session, used when load() finds an exported .onnx model
+        self.ort_session = None
+        self._ort_binding = None
+        self._ort_in = None
+        self._ort_out = None
+        
+        # (weight.T, bias) per Linear layer for the NumPy inference path
+        self._np_layers = None
+        self._np_dtype = np.float32
 
     def act_inference(self, state):
         """Inference mode: select action with highest Q-value."""
         state_tensor = torch.FloatTensor(state).unsqueeze(0).to(self.device)
-        with torch.no_grad():
+        with torch.inference_mode():
             q_values = self.policy_net(state_tensor)
         return torch.argmax(q_values).item()
 
+    def act_inference_batch(self, states):
+        """
+        Inference mode for several traffic lights at once.
+        
+        states is a (n_tls, state_size) float32 array; returns one action per row
+        from a single forward pass.
+        """
+        self.submit_batch(states)
+        return self.collect_batch()
+
+    @torch.inference_mode()
+    def submit_batch(self, states):
+        """
+        Start the batched forward pass; collect_batch() returns the actions.
+        
+        On CUDA the forward pass and the copy of the actions to pinned host
+        memory are only queued, so the caller can do other work (TraCI reads)
+        while the GPU runs. The other backends compute the actions right away.
+        Runs under torch.inference_mode, which skips the autograd bookkeeping
+        no_grad still does; the reused buffers are therefore inference tensors
+        and are only touched from here.
+        """
+        n_states = states.shape[0]
+        if self.uses_onnx(n_states):
+            # Input and output buffers are bound once; only the data is copied
+            np.copyto(self._ort_in, states)
+            self.ort_session.run_with_iobinding(self._ort_binding)
+            self._pending = self._ort_out.argmax(1)
+            return
+        
+        if self.uses_numpy():
+            self._pending = self.act_np(states)
+            return
+        
+        if self._state_buffer is None or self._state_buffer.shape[0] != n_states:
+            self._state_buffer = torch.empty(
+                (n_states, self.state_size),
+                dtype=torch.float32,
+                pin_memory=self.device.type == "cuda"
+            )
+        self._state_buffer.copy_(torch.from_numpy(states))
+        
+        if self.device.type == "cuda" and not self._compiled:
+            # Replay the recorded kernels instead of launching each layer
+            if self._graph is None or self._static_in.shape[0] != n_states:
+                self._capture_graph(n_states)
+            self._static_in.copy_(self._state_buffer, non_blocking=True)
+            self._graph.replay()
+            q_values = self._static_out
+        else:
+            q_values = self.policy_net(self._state_buffer.to(self.device, non_blocking=True))
+        
+        if self.device.type != "cuda":
+            self._pending = q_values.argmax(1).cpu().numpy()
+            return
+        
+        if self._action_buffer is None or self._action_buffer.shape[0] != n_states:
+            self._action_buffer = torch.empty(n_states, dtype=torch.int64, pin_memory=True)
+            self._action_ready = torch.cuda.Event()
+        self._action_buffer.copy_(q_values.argmax(1), non_blocking=True)
+        self._action_ready.record()
+        self._pending_on_gpu = True
+
+    def collect_batch(self):
+        """Actions of the last submit_batch, waiting for the GPU if needed."""
+        if self._pending_on_gpu:
+            self._pending_on_gpu = False
+            self._action_ready.synchronize()
+            return self._action_buffer.numpy().copy()
+        if self._pending is None:
+            raise RuntimeError("collect_batch() called without a pending submit_batch()")
+        actions, self._pending = self._pending, None
+        return actions
+
+    def use_numpy(self, dtype=np.float32):
+        """
+        Serve batched inference with plain NumPy instead of PyTorch.
+        
+        For a 3-32-32-2 MLP the framework dispatch costs far more than the few
+        hundred FLOPs, so the loaded float weights are copied once into
+        contiguous (in, out) matrices and evaluated with three matmuls.
+        Call after load().
+        
+        dtype sets the storage/compute precision of the weights. np.float16 (or
+        ml_dtypes.bfloat16) halves their size, but NumPy has no BLAS kernels
+        for half precision and the float32 weights (~5 KB) already fit in L1,
+        so float32 is usually the faster choice on CPU.
+        """
+        linears = [m for m in self._float_policy().modules() if isinstance(m, nn.Linear)]
+        self._np_dtype = dtype
+        self._np_layers = [
+            (
+                np.ascontiguousarray(layer.weight.detach().cpu().numpy().T.astype(dtype)),
+                layer.bias.detach().cpu().numpy().astype(dtype)
+            )
+            for layer in linears
+        ]
+
+    def act_np(self, states):
+        """NumPy forward pass: ReLU on the hidden layers, argmax of the Q-values."""
+        hidden = states.astype(self._np_dtype, copy=False)
+        for weight, bias in self._np_layers[:-1]:
+            hidden = np.maximum(hidden @ weight + bias, 0.0)
+        weight, bias = self._np_layers[-1]
+        return np.argmax(hidden @ weight + bias, axis=1)
+
+    def _float_policy(self):
+        """The float policy network, unwrapped from quantization or torch.compile."""
+        if self._float_net is not None:
+            return self._float_net
+        return getattr(self.policy_net, "_orig_mod", self.policy_net)
+
+    def warmup(self, n_states):
+        """
+        Run one dummy batch through the active inference path.
+        
+        Moves one-time costs (allocator growth, CUDA graph recording, cuDNN/ORT
+        initialisation) out of the simulation loop.
+        """
+        self.act_inference_batch(np.zeros((n_states, self.state_size), dtype=np.float32))
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def uses_numpy(self):
+        """True when batched inference runs on the NumPy path."""
+        return self._np_layers is not None
+
+    def uses_onnx(self, n_states):
+        """True when the ONNX Runtime session serves batches of n_states."""
+        return self._ort_in is not None and self._ort_in.shape[0] == n_states
+
+    def export_onnx(self, path, batch=3):
+        """
+        Export the policy network to ONNX for a fixed batch size.
+        
+        Save it next to the .pth weights with the same name (e.g.
+        final_model.onnx) so load() picks it up for ONNX Runtime inference.
+        The batch must match the number of controlled traffic lights.
+        """
+        torch.onnx.export(
+            self._float_policy(),
+            torch.zeros((batch, self.state_size), device=self.device),
+            path,
+            opset_version=17,
+            input_names=["s"],
+            output_names=["q"],
+            dynamic_axes=None
+        )
+
+    def _load_onnx(self, path):
+        """Open an ONNX Runtime session on path and bind static I/O buffers."""
+        self.ort_session = ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+        batch = self.ort_session.get_inputs()[0].shape[0]
+        self._ort_in = np.zeros((batch, self.state_size), dtype=np.float32)
+        self._ort_out = np.zeros((batch, self.action_size), dtype=np.float32)
+        self._ort_binding = self.ort_session.io_binding()
+        self._ort_binding.bind_ortvalue_input("s", ort.OrtValue.ortvalue_from_numpy(self._ort_in))
+        self._ort_binding.bind_ortvalue_output("q", ort.OrtValue.ortvalue_from_numpy(self._ort_out))
+
+    def _drop_onnx(self):
+        """Forget the ONNX Runtime session so inference uses the other paths."""
+        self.ort_session = None
+        self._ort_binding = None
+        self._ort_in = None
+        self._ort_out = None
+
+    def quantize(self):
+        """
+        Quantize the Linear layers to int8 for PyTorch CPU inference.
+        
+        Dynamic quantization needs no calibration: weights are packed once here
+        and activations are quantized on the fly. Opt-in and only useful when
+        PyTorch serves CPU inference (Group2 uses the NumPy path instead).
+        Call after load(); the float network is kept for use_numpy and
+        export_onnx, and load() goes back to it, so call quantize() again
+        after reloading weights.
+        """
+        self._float_net = self._float_policy()
+        self.policy_net = torch.ao.quantization.quantize_dynamic(
+            self._float_net, {nn.Linear}, dtype=torch.qint8
+        )
+        self.policy_net.eval()
+        self._compiled = False
+        self._graph = None
+
+    def compile_policy(self, batch_size):
+        """
+        Compile the policy network to remove per-layer Python dispatch.
+        
+        Call after load(). Uses torch.compile when available (its
+        "reduce-overhead" mode brings its own CUDA graphs) and falls back to
+        torch.jit.trace otherwise. A warm-up forward pass pays the compilation
+        cost here rather than inside the simulation loop.
+        
+        Returns the name of the backend in use.
+        """
+        dummy = torch.zeros((batch_size, self.state_size), device=self.device)
+        try:
+            compiled = torch.compile(self.policy_net, mode="reduce-overhead", fullgraph=True)
+            with torch.no_grad():
+                compiled(dummy)
+            backend = "torch.compile"
+        except Exception:
+            with torch.no_grad():
+                compiled = torch.jit.trace(self.policy_net, dummy)
+            backend = "torch.jit.trace"
+        
+        self.policy_net = compiled
+        self._compiled = backend == "torch.compile"
+        self._graph = None
+        return backend
+
+    def _capture_graph(self, n_states):
+        """
+        Record the forward pass for a fixed batch of n_states as a CUDA graph.
+        
+        The graph is bound to the current weight tensors and batch size, so it is
+        recorded again after load() or when the batch size changes.
+        """
+        self._static_in = torch.zeros((n_states, self.state_size), device=self.device)
+        
+        # Warm up on a side stream before capture, as required by CUDA graphs
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream), torch.no_grad():
+            for _ in range(3):
+                self.policy_net(self._static_in)
+        torch.cuda.current_stream().wait_stream(side_stream)
+        
+        self._graph = torch.cuda.CUDAGraph()
+        with torch.no_grad(), torch.cuda.graph(self._graph):
+            self._static_out = self.policy_net(self._static_in)
+
     def load(self, path):
-        """Load pre-trained model weights."""
+        """
+        Load pre-trained model weights.
+        
+        On CPU, an up-to-date .onnx export next to the weights (see export_onnx)
+        is also loaded into ONNX Runtime when onnxruntime is installed.
+        """
         if not os.path.exists(path):
             return False
+        # A session from an earlier load() must not outlive these weights
+        self._drop_onnx()
+        # Load into the plain float network, not a quantized or compiled copy
+        self.policy_net = self._float_policy()
+        self._float_net = None
+        self._compiled = False
         try:
-            self.policy_net.load_state_dict(torch.load(path, map_location=self.device))
+            if TORCH_HAS_MMAP:
+                # Let the network take the loaded tensors as-is. Off CPU the
+                # file is memory-mapped only until the tensors are moved to the
+                # device; on CPU mmap would keep the parameters backed by the
+                # file (locking it on Windows) while use_numpy copies them
+                # anyway. mmap also needs the zip checkpoint format.
+                state_dict = torch.load(
+                    path, map_location=self.device, weights_only=True,
+                    mmap=self.device.type != "cpu" and zipfile.is_zipfile(path)
+                )
+                self.policy_net.load_state_dict(state_dict, assign=True, strict=True)
+            else:
+                state_dict = torch.load(path, map_location=self.device, weights_only=True)
+                self.policy_net.load_state_dict(state_dict, strict=True)
             self.policy_net.eval()
+            self._graph = None
+            self._np_layers = None
+            
+            onnx_path = os.path.splitext(path)[0] + ".onnx"
+            if (ort is not None and self.device.type == "cpu"
+                    and os.path.exists(onnx_path)
+                    and os.path.getmtime(onnx_path) >= os.path.getmtime(path)):
+                # ONNX Runtime is only an accelerator: the weights are loaded,
+                # so a bad export falls back to the NumPy / PyTorch paths
+                try:
+                    self._load_onnx(onnx_path)
+                except Exception as e:
+                    self._drop_onnx()
+                    print(f"Warning: ignoring ONNX model {onnx_path}: {e}")
             return True
         except Exception as e:
             print(f"Error loading model: {e}")
@@ -81,6 +393,12 @@ class DQNAgent:
 # ==========================================
 # 3. SUMO ENVIRONMENT FUNCTIONS
 # ==========================================
+# Phase transitions of the controlled lights: yellow phase -> following green,
+# and the green phase selected by each RL action
+YELLOW_NEXT = {1: 2, 3: 0}
+ACTION_TARGET = (0, 2)
+
+
 def setup_sumo():
     """Configure SUMO environment and return tools path."""
     if 'SUMO_HOME' not in os.environ:
@@ -104,7 +422,43 @@ def get_sumo_binary():
     return os.path.join(sumo_home, 'bin', 'sumo')
 
 
-def get_state(tls_id):
+def import_traci():
+    """
+    Return the SUMO control module.
+    
+    With SUMO_USE_LIBSUMO=1, SUMO runs in-process through libsumo: same API as
+    TraCI but direct C++ calls instead of a socket message per call. TraCI
+    stays the default so GUI and debugging sessions keep working.
+    """
+    if os.environ.get("SUMO_USE_LIBSUMO") == "1":
+        import libsumo
+        return libsumo
+    import traci
+    return traci
+
+
+# Subscription getters and result keys bound once, so the per-decision
+# helpers use local names instead of resolving traci.lane.* /
+# traci.trafficlight.* / traci.constants.* every call
+SumoHandles = namedtuple(
+    "SumoHandles",
+    ["lane_results", "tls_results", "halting_key", "waiting_key", "phase_key"]
+)
+
+
+def make_handles(traci):
+    """Bind the subscription getters of a traci/libsumo module and their keys."""
+    import traci.constants as tc
+    return SumoHandles(
+        lane_results=traci.lane.getSubscriptionResults,
+        tls_results=traci.trafficlight.getSubscriptionResults,
+        halting_key=tc.LAST_STEP_VEHICLE_HALTING_NUMBER,
+        waiting_key=tc.VAR_WAITING_TIME,
+        phase_key=tc.TL_CURRENT_PHASE
+    )
+
+
+def get_state(tls_id, lanes, halting=None, phase=None, handles=None):
     """
     Extract state from traffic light.
     
@@ -112,30 +466,55 @@ def get_state(tls_id):
     1. Total Queue Length (Normalized)
     2. Max Queue Length (Normalized)  
     3. Current Phase Index (Normalized)
-    """
-    import traci
     
-    lanes = traci.trafficlight.getControlledLanes(tls_id)
-    halting = [traci.lane.getLastStepHaltingNumber(lane) for lane in lanes]
-    
-    total_queue = sum(halting) / 50.0
-    max_queue = max(halting) / 20.0
-    phase = traci.trafficlight.getPhase(tls_id) / 4.0
-    
-    return np.array([total_queue, max_queue, phase], dtype=np.float32)
+    Lane and phase values are read from the subscriptions set up in Group2,
+    so no TraCI request is sent here. halting is an optional preallocated
+    int32 buffer of len(lanes) reused between calls; phase is the current
+    phase when the caller has already read it; handles are the bound getters
+    from make_handles.
+    """
+    if handles is None:
+        handles = make_handles(import_traci())
+    if halting is None:
+        halting = np.empty(len(lanes), dtype=np.int32)
+    lane_results = handles.lane_results
+    halting_key = handles.halting_key
+    for i, lane in enumerate(lanes):
+        halting[i] = lane_results(lane)[halting_key]
+    
+    total_queue = halting.sum() / 50.0
+    max_queue = halting.max() / 20.0
+    if phase is None:
+        phase = handles.tls_results(tls_id)[handles.phase_key]
+    
+    return np.array([total_queue, max_queue, phase / 4.0], dtype=np.float32)
 
 
-def get_reward(tls_id, waiting_time_prev):
+def get_reward(tls_id, lanes, waiting_time_prev, halting=None, waiting=None, handles=None):
     """
     Calculate reward signal (for monitoring only, not used for training).
     
     Reward = (Waiting Time Reduction) - (Queue Penalty)
-    """
-    import traci
     
-    lanes = traci.trafficlight.getControlledLanes(tls_id)
-    current_wait = sum([traci.lane.getWaitingTime(lane) for lane in lanes])
-    current_queue = sum([traci.lane.getLastStepHaltingNumber(lane) for lane in lanes])
+    halting and waiting are optional preallocated buffers of len(lanes)
+    (int32 and float64) reused between calls; handles are the bound getters
+    from make_handles.
+    """
+    if handles is None:
+        handles = make_handles(import_traci())
+    if halting is None:
+        halting = np.empty(len(lanes), dtype=np.int32)
+    if waiting is None:
+        waiting = np.empty(len(lanes), dtype=np.float64)
+    get_results = handles.lane_results
+    halting_key = handles.halting_key
+    waiting_key = handles.waiting_key
+    for i, lane in enumerate(lanes):
+        results = get_results(lane)
+        halting[i] = results[halting_key]
+        waiting[i] = results[waiting_key]
+    current_wait = float(waiting.sum())
+    current_queue = int(halting.sum())
     
     diff = waiting_time_prev - current_wait
     reward = (diff * 0.2) - (current_queue * 0.05)
@@ -223,8 +602,17 @@ def Group2(
     # Create results directory
     os.makedirs(results_dir, exist_ok=True)
     
-    # Setup device
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # Setup device: the 3-32-32-2 policy is far too small to gain from a GPU,
+    # host/device copies would cost more than the forward pass, so it runs on
+    # CPU. SUMO_RL_DEVICE (e.g. "cuda") overrides this for experiments and
+    # falls back to CPU when that device is not usable here.
+    requested_device = os.environ.get("SUMO_RL_DEVICE", "cpu")
+    try:
+        device = torch.device(requested_device)
+        torch.empty(0, device=device)
+    except (RuntimeError, AssertionError) as e:
+        print(f"Warning: device {requested_device!r} unavailable ({e}), using CPU")
+        device = torch.device("cpu")
     if verbose:
         print(f"Device: {device}")
     
@@ -240,8 +628,9 @@ def Group2(
             'steps': 0
         }
     
-    # Import traci after setting up path
-    import traci
+    # Import traci (or libsumo) after setting up path
+    import traci.constants as tc
+    traci = import_traci()
     
     # Load agent
     agent = DQNAgent(state_size=3, action_size=2, device=device)
@@ -256,6 +645,10 @@ def Group2(
     if verbose:
         print(f"✓ Model loaded from {model_path}")
     
+    # On CPU, skip PyTorch entirely for this tiny network
+    if device.type == "cpu":
+        agent.use_numpy()
+    
     sumo_bin = get_sumo_binary()
     
     # Output files
@@ -280,64 +673,138 @@ def Group2(
         # Start SUMO
         traci.start(sumo_cmd)
         
-        # Initialize traffic lights
+        # Initialize traffic lights and subscribe to the values read every
+        # decision, so they arrive with each simulationStep instead of one
+        # TraCI round trip per lane
+        lanes_by_tls = {}
         for tls in tls_ids:
             try:
                 traci.trafficlight.setProgram(tls, "0")
-            except traci.exceptions.TraCIException:
+            except traci.TraCIException:
                 if verbose:
                     print(f"Warning: Traffic light {tls} not found in network")
+                continue
+            lanes_by_tls[tls] = tuple(traci.trafficlight.getControlledLanes(tls))
+            for lane in set(lanes_by_tls[tls]):
+                traci.lane.subscribe(
+                    lane, [tc.LAST_STEP_VEHICLE_HALTING_NUMBER, tc.VAR_WAITING_TIME]
+                )
+            traci.trafficlight.subscribe(tls, [tc.TL_CURRENT_PHASE])
+        
+        # Per-TLS buffers reused by get_state / get_reward every decision
+        halting_bufs = {t: np.empty(len(l), dtype=np.int32) for t, l in lanes_by_tls.items()}
+        waiting_bufs = {t: np.empty(len(l), dtype=np.float64) for t, l in lanes_by_tls.items()}
+        
+        # Compile for the number of controlled lights before the timed loop
+        if lanes_by_tls:
+            if agent.uses_onnx(len(lanes_by_tls)):
+                backend = "ONNX Runtime"
+            elif agent.uses_numpy():
+                backend = "NumPy"
+            else:
+                backend = agent.compile_policy(len(lanes_by_tls))
+            agent.warmup(len(lanes_by_tls))
+            if verbose:
+                print(f"✓ Policy inference backend: {backend}")
         
-        # Initialize tracking data
-        tls_data = {t: {"prev_wait": 0, "phase_time": 0} for t in tls_ids}
+        # Initialize tracking data, one array slot per controlled light
+        # (same order as lanes_by_tls)
+        n_tls = len(lanes_by_tls)
+        prev_wait = np.zeros(n_tls, dtype=np.float64)
+        phase_time = np.zeros(n_tls, dtype=np.int32)
+        current_phase_arr = np.zeros(n_tls, dtype=np.int8)
+        # Yellow flag per phase index (int8 phases, so 128 entries cover all)
+        is_yellow_lut = np.zeros(128, dtype=bool)
+        is_yellow_lut[list(YELLOW_NEXT)] = True
         total_reward = 0
         step_count = 0
         
+        # Precompute the step budget once instead of polling getTime() every
+        # step (the simulation may not begin at t=0)
+        step_length = traci.simulation.getDeltaT()
+        max_steps = int(round((scenario_duration - traci.simulation.getTime()) / step_length))
+        
         if verbose:
             print(f"Running evaluation for {scenario_duration} seconds...")
         
+        # Bind the calls made every step / decision to local names
+        simulation_step = traci.simulationStep
+        get_min_expected = traci.simulation.getMinExpectedNumber
+        set_phase = traci.trafficlight.setPhase
+        handles = make_handles(traci)
+        tls_results = handles.tls_results
+        phase_key = handles.phase_key
+        
         # Main simulation loop
-        while traci.simulation.getTime() < scenario_duration:
-            traci.simulationStep()
-            step_count += 1
+        for step_count in range(1, max_steps + 1):
+            simulation_step()
+            
+            # Stop early once every vehicle has left the network
+            if step_count % 100 == 0 and get_min_expected() == 0:
+                break
             
             # Make decisions every 5 seconds
-            if step_count % 5 == 0:
-                for tls in tls_ids:
+            if step_count % 5 == 0 and lanes_by_tls:
+                # Read each phase once; it feeds both the state and the logic
+                for i, tls in enumerate(lanes_by_tls):
+                    current_phase_arr[i] = tls_results(tls)[phase_key]
+                
+                # The action is only used by lights in green past min_green;
+                # during yellow or before min_green both actions do the same
+                is_yellow = is_yellow_lut[current_phase_arr]
+                deciding = ~is_yellow & (phase_time >= min_green)
+                any_deciding = deciding.any()
+                if any_deciding:
+                    # Select the actions of all traffic lights in one forward
+                    # pass (a fixed batch keeps ONNX / CUDA graph shapes static)
+                    states = np.stack([
+                        get_state(tls, lanes, halting_bufs[tls], current_phase_arr[i], handles)
+                        for i, (tls, lanes) in enumerate(lanes_by_tls.items())
+                    ])
+                    agent.submit_batch(states)
+                
+                # Rewards read this step's subscription results, which setPhase
+                # does not change, so they are computed while the forward pass
+                # runs on the GPU
+                for i, (tls, lanes) in enumerate(lanes_by_tls.items()):
+                    try:
+                        reward, prev_wait[i] = get_reward(
+                            tls, lanes, prev_wait[i],
+                            halting_bufs[tls], waiting_bufs[tls], handles
+                        )
+                        total_reward += reward
+                    except traci.TraCIException:
+                        # Traffic light not in network, skip
+                        pass
+                
+                if any_deciding:
+                    actions = agent.collect_batch()
+                
+                for i, tls in enumerate(lanes_by_tls):
                     try:
-                        # Get state and select action
-                        state = get_state(tls)
-                        action = agent.act_inference(state)
-                        
                         # Apply action logic
-                        current_phase = traci.trafficlight.getPhase(tls)
+                        current_phase = int(current_phase_arr[i])
                         
-                        if current_phase == 1 or current_phase == 3:
+                        if is_yellow[i]:
                             # Yellow phase: wait for it to complete
-                            tls_data[tls]["phase_time"] += 5
-                            if tls_data[tls]["phase_time"] >= yellow_duration:
-                                next_phase = 2 if current_phase == 1 else 0
-                                traci.trafficlight.setPhase(tls, next_phase)
-                                tls_data[tls]["phase_time"] = 0
+                            phase_time[i] += 5
+                            if phase_time[i] >= yellow_duration:
+                                set_phase(tls, YELLOW_NEXT[current_phase])
+                                phase_time[i] = 0
+                        elif not deciding[i]:
+                            # Green phase before min_green: keep it
+                            phase_time[i] += 5
                         else:
                             # Green phase: apply RL decision
-                            target_phase = 0 if action == 0 else 2
+                            target_phase = ACTION_TARGET[actions[i]]
                             
                             if current_phase != target_phase:
-                                if tls_data[tls]["phase_time"] >= min_green:
-                                    traci.trafficlight.setPhase(tls, current_phase + 1)
-                                    tls_data[tls]["phase_time"] = 0
-                                else:
-                                    tls_data[tls]["phase_time"] += 5
+                                set_phase(tls, current_phase + 1)
+                                phase_time[i] = 0
                             else:
-                                tls_data[tls]["phase_time"] += 5
-                        
-                        # Calculate and accumulate reward
-                        reward, new_wait = get_reward(tls, tls_data[tls]["prev_wait"])
-                        tls_data[tls]["prev_wait"] = new_wait
-                        total_reward += reward
+                                phase_time[i] += 5
                     
-                    except traci.exceptions.TraCIException:
+                    except traci.TraCIException:
                         # Traffic light not in network, skip
                         pass
         
@@ -364,8 +831,7 @@ def Group2(
             traceback.print_exc()
         
         try:
-            if traci.isLoaded():
-                traci.close()
+            traci.close()
         except:
             pass
         